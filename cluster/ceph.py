@@ -7,12 +7,16 @@ import time
 import uuid
 import threading
 import logging
+import json
 
 from cluster import Cluster
 
 
 logger = logging.getLogger("cbt")
 
+# Match any of these things to continue checking health
+_HEALTH_CHECK_SET = frozenset(("degraded", "peering", "recovery_wait", "stuck", "inactive", "unclean", "recovery", "stale"))
+
 
 class Ceph(Cluster):
     def __init__(self, config):
@@ -46,6 +50,18 @@ class Ceph(Cluster):
         self.stoprequest = threading.Event()
         self.haltrequest = threading.Event()
 
+        # The node lists don't change during a run, so only build them once
+        self.nodes_head = settings.getnodes('head')
+        self.nodes_osds = settings.getnodes('osds')
+        self.nodes_all = settings.getnodes('clients', 'mons', 'osds', 'rgws', 'mds')
+
+        # Per-OSD command templates used by make_osds, filled in with str.format
+        self.osd_create_tmpl = 'echo OSD:$(sudo ceph -c {conf} osd create {uuid}):{uuid}:{host}:{i}'
+        self.osd_build_tmpls = (
+            'sudo ceph -c {conf} osd crush add osd.{osdnum} 1.0 host={host} rack=localrack root=default',
+            'sudo sh -c "ulimit -n 16384 && ulimit -c unlimited && exec {osd_cmd} -c {conf} -i {osdnum} --mkfs --mkkey --osd-uuid {uuid}"',
+            'sudo ceph -c {conf} -i {key_fn} auth add osd.{osdnum} osd "allow *" mon "allow profile osd"')
+        self.osd_start_tmpl = '{osd_cmd} -c {conf} -i {osdnum} --pid-file={pidfile}'
 
     def initialize(self): 
         # safety check to make sure we don't blow away an existing cluster!
@@ -61,17 +77,15 @@ class Ceph(Cluster):
         self.shutdown()
 
         # Cleanup old junk and create new junk
-        self.cleanup()
+        logger.info('Deleting %s', self.tmp_dir)
         common.mkdir_p(self.tmp_dir)
-        common.pdsh(settings.getnodes('head', 'clients', 'mons', 'osds', 'rgws', 'mds'), 'mkdir -p -m0755 -- %s' % self.tmp_dir).communicate()
-        common.pdsh(settings.getnodes('clients', 'mons', 'osds', 'rgws', 'mds'), 'mkdir -p -m0755 -- %s' % self.pid_dir).communicate()
-        common.pdsh(settings.getnodes('clients', 'mons', 'osds', 'rgws', 'mds'), 'mkdir -p -m0755 -- %s' % self.log_dir).communicate()
-        common.pdsh(settings.getnodes('clients', 'mons', 'osds', 'rgws', 'mds'), 'mkdir -p -m0755 -- %s' % self.monitoring_dir).communicate()
-        common.pdsh(settings.getnodes('clients', 'mons', 'osds', 'rgws', 'mds'), 'mkdir -p -m0755 -- %s' % self.core_dir).communicate()
+        common.pdsh(self.nodes_all, 'sudo rm -rf %s && mkdir -p -m0755 -- %s %s %s %s %s' % (self.tmp_dir, self.tmp_dir, self.pid_dir, self.log_dir, self.monitoring_dir, self.core_dir)).communicate()
+        # The head node isn't cleaned up, it just needs the tmp_dir
+        common.run_local_or_pdsh(self.nodes_head, 'mkdir -p -m0755 -- %s' % self.tmp_dir).communicate()
         self.distribute_conf()
 
         # Set the core directory
-        common.pdsh(settings.getnodes('clients', 'mons', 'osds', 'rgws', 'mds'), 'echo "%s/core.%%e.%%p.%%h.%%t" | sudo tee /proc/sys/kernel/core_pattern' % self.tmp_dir).communicate()
+        common.pdsh(self.nodes_all, 'echo "%s/core.%%e.%%p.%%h.%%t" | sudo tee /proc/sys/kernel/core_pattern' % self.tmp_dir).communicate()
 
         # Create the filesystems
         self.setup_fs()
@@ -103,23 +117,20 @@ class Ceph(Cluster):
         return True
 
     def shutdown(self):
-        nodes = settings.getnodes('clients', 'osds', 'mons', 'rgws', 'mds')
-
-        common.pdsh(nodes, 'sudo killall -9 massif-amd64-li').communicate()
-        common.pdsh(nodes, 'sudo killall -9 memcheck-amd64-').communicate()
-        common.pdsh(nodes, 'sudo killall -9 ceph-osd').communicate()
-        common.pdsh(nodes, 'sudo killall -9 ceph-mon').communicate()
-        common.pdsh(nodes, 'sudo killall -9 ceph-mds').communicate()
-        common.pdsh(nodes, 'sudo killall -9 rados').communicate()
-        common.pdsh(nodes, 'sudo killall -9 rest-bench').communicate()
-        common.pdsh(nodes, 'sudo killall -9 radosgw').communicate()
-        common.pdsh(nodes, 'sudo killall -9 radosgw-admin').communicate()
-        common.pdsh(nodes, 'sudo /etc/init.d/apache2 stop').communicate()
-        common.pdsh(nodes, 'sudo killall -9 pdsh').communicate()
+        nodes = self.nodes_all
+
+        # Do everything in a single pdsh run.  Commands are joined with ';'
+        # so a missing process (killall returns non-zero) doesn't stop the rest.
+        cmd = ' ; '.join([
+            'sudo killall -9 massif-amd64-li memcheck-amd64- ceph-osd ceph-mon ceph-mds rados rest-bench radosgw radosgw-admin',
+            'sudo /etc/init.d/apache2 stop',
+            'sudo killall -9 pdsh',
+            'true'])
+        common.pdsh(nodes, cmd).communicate()
         monitoring.stop()
 
     def cleanup(self):
-        nodes = settings.getnodes('clients', 'osds', 'mons', 'rgws', 'mds')
+        nodes = self.nodes_all
         logger.info('Deleting %s', self.tmp_dir)
         common.pdsh(nodes, 'sudo rm -rf %s' % self.tmp_dir).communicate()
 
@@ -132,23 +143,28 @@ class Ceph(Cluster):
         if fs == '':
              settings.shutdown("No OSD filesystem specified.  Exiting.")
 
-        for device in xrange (0,sc.get('osds_per_node')):
-            osds = settings.getnodes('osds')
-            common.pdsh(osds, 'sudo umount /dev/disk/by-partlabel/osd-device-%s-data' % device).communicate()
-            common.pdsh(osds, 'sudo rm -rf %s/osd-device-%s-data' % (self.mnt_dir, device)).communicate()
-            common.pdsh(osds, 'sudo mkdir -p -m0755 -- %s/osd-device-%s-data' % (self.mnt_dir, device)).communicate()
-
-            if fs == 'tmpfs':
-                logger.info('using tmpfs osds, not creating a file system.')
-            elif fs == 'zfs':
-                logger.info('ruhoh, zfs detected.  No mkfs for you!')
-                common.pdsh(osds, 'sudo zpool destroy osd-device-%s-data' % device).communicate()
-                common.pdsh(osds, 'sudo zpool create -f -O xattr=sa -m legacy osd-device-%s-data /dev/disk/by-partlabel/osd-device-%s-data' % (device, device)).communicate()
-                common.pdsh(osds, 'sudo zpool add osd-device-%s-data log /dev/disk/by-partlabel/osd-device-%s-zil' % (device, device)).communicate()
-                common.pdsh(osds, 'sudo mount %s -t zfs osd-device-%s-data %s/osd-device-%s-data' % (mount_opts, device, self.mnt_dir, device)).communicate()
-            else: 
-                common.pdsh(osds, 'sudo mkfs.%s %s /dev/disk/by-partlabel/osd-device-%s-data' % (fs, mkfs_opts, device)).communicate()
-                common.pdsh(osds, 'sudo mount %s -t %s /dev/disk/by-partlabel/osd-device-%s-data %s/osd-device-%s-data' % (mount_opts, fs, device, self.mnt_dir, device)).communicate()
+        # Build one script that loops over the devices on the remote side so
+        # every osd host is set up with a single pdsh run.  $i and $odd are
+        # remote shell variables.
+        cmds = ['odd=osd-device-$i-data',
+                'sudo umount /dev/disk/by-partlabel/$odd',
+                'sudo rm -rf %s/$odd' % self.mnt_dir,
+                'sudo mkdir -p -m0755 -- %s/$odd' % self.mnt_dir]
+
+        if fs == 'tmpfs':
+            logger.info('using tmpfs osds, not creating a file system.')
+        elif fs == 'zfs':
+            logger.info('ruhoh, zfs detected.  No mkfs for you!')
+            cmds.append('sudo zpool destroy $odd')
+            cmds.append('sudo zpool create -f -O xattr=sa -m legacy $odd /dev/disk/by-partlabel/$odd')
+            cmds.append('sudo zpool add $odd log /dev/disk/by-partlabel/osd-device-$i-zil')
+            cmds.append('sudo mount %s -t zfs $odd %s/$odd' % (mount_opts, self.mnt_dir))
+        else:
+            cmds.append('sudo mkfs.%s %s /dev/disk/by-partlabel/$odd' % (fs, mkfs_opts))
+            cmds.append('sudo mount %s -t %s /dev/disk/by-partlabel/$odd %s/$odd' % (mount_opts, fs, self.mnt_dir))
+
+        script = 'for i in $(seq 0 %d); do %s; done' % (sc.get('osds_per_node') - 1, '; '.join(cmds))
+        common.pdsh(self.nodes_osds, script).communicate()
 
 
     def distribute_conf(self):
@@ -156,14 +172,14 @@ class Ceph(Cluster):
         conf_file = self.config.get("conf_file")
         logger.info("Distributing %s.", conf_file)
         common.pdcp(nodes, '', conf_file, self.tmp_conf).communicate()
-        common.pdsh(nodes, 'sudo mv /etc/ceph/ceph.conf /etc/ceph/ceph.conf.cbt.bak').communicate()
-        common.pdsh(nodes, 'sudo ln -s %s /etc/ceph/ceph.conf' % self.tmp_conf).communicate()
+        # Only back up a real config file, a symlink is left over from a previous run
+        common.pdsh(nodes, '[ -L /etc/ceph/ceph.conf ] || sudo mv /etc/ceph/ceph.conf /etc/ceph/ceph.conf.cbt.bak; sudo ln -sfn %s /etc/ceph/ceph.conf' % self.tmp_conf).communicate()
 
     def make_mons(self):
         # Build and distribute the keyring
-        common.pdsh(settings.getnodes('head'), 'ceph-authtool --create-keyring --gen-key --name=mon. %s --cap mon \'allow *\'' % self.keyring_fn).communicate()
-        common.pdsh(settings.getnodes('head'), 'ceph-authtool --gen-key --name=client.admin --set-uid=0 --cap mon \'allow *\' --cap osd \'allow *\' --cap mds allow %s' % self.keyring_fn).communicate()
-        common.rscp(settings.getnodes('head'), self.keyring_fn, '%s.tmp' % self.keyring_fn).communicate()
+        common.run_local_or_pdsh(self.nodes_head, 'ceph-authtool --create-keyring --gen-key --name=mon. %s --cap mon \'allow *\'' % self.keyring_fn).communicate()
+        common.run_local_or_pdsh(self.nodes_head, 'ceph-authtool --gen-key --name=client.admin --set-uid=0 --cap mon \'allow *\' --cap osd \'allow *\' --cap mds allow %s' % self.keyring_fn).communicate()
+        common.rscp(self.nodes_head, self.keyring_fn, '%s.tmp' % self.keyring_fn).communicate()
         common.pdcp(settings.getnodes('mons', 'osds', 'rgws', 'mds'), '', '%s.tmp' % self.keyring_fn, self.keyring_fn).communicate()
 
         # Build the monmap, retrieve it, and distribute it
@@ -175,22 +191,28 @@ class Ceph(Cluster):
            for mon, addr in mons.iteritems():
                 cmd = cmd + ' --add %s %s' % (mon, addr)
         cmd = cmd + ' --print %s' % self.monmap_fn
-        common.pdsh(settings.getnodes('head'), cmd).communicate()
-        common.rscp(settings.getnodes('head'), self.monmap_fn, '%s.tmp' % self.monmap_fn).communicate()
+        common.run_local_or_pdsh(self.nodes_head, cmd).communicate()
+        common.rscp(self.nodes_head, self.monmap_fn, '%s.tmp' % self.monmap_fn).communicate()
         common.pdcp(settings.getnodes('mons'), '', '%s.tmp' % self.monmap_fn, self.monmap_fn).communicate()
 
-        # Build the ceph-mons
+        # Build the ceph-mons, all hosts at once
         user = settings.cluster.get('user')
+        procs = []
         for monhost, mons in monhosts.iteritems():
             if user:
                 monhost = '%s@%s' % (user, monhost)
             for mon, addr in mons.iteritems():
-                common.pdsh(monhost, 'sudo rm -rf %s/mon.%s' % (self.tmp_dir, mon)).communicate()
-                common.pdsh(monhost, 'mkdir -p %s/mon.%s' % (self.tmp_dir, mon)).communicate()
-                common.pdsh(monhost, 'sudo sh -c "ulimit -c unlimited && exec %s --mkfs -c %s -i %s --monmap=%s --keyring=%s"' % (self.ceph_mon_cmd, self.tmp_conf, mon, self.monmap_fn, self.keyring_fn)).communicate()
-                common.pdsh(monhost, 'cp %s %s/mon.%s/keyring' % (self.keyring_fn, self.tmp_dir, mon)).communicate()
-            
-        # Start the mons
+                script = ' && '.join([
+                    'sudo rm -rf %s/mon.%s' % (self.tmp_dir, mon),
+                    'mkdir -p %s/mon.%s' % (self.tmp_dir, mon),
+                    'sudo sh -c "ulimit -c unlimited && exec %s --mkfs -c %s -i %s --monmap=%s --keyring=%s"' % (self.ceph_mon_cmd, self.tmp_conf, mon, self.monmap_fn, self.keyring_fn),
+                    'cp %s %s/mon.%s/keyring' % (self.keyring_fn, self.tmp_dir, mon)])
+                procs.append(common.pdsh(monhost, script))
+        for p in procs:
+            p.communicate()
+
+        # Start the mons, all hosts at once
+        procs = []
         for monhost, mons in monhosts.iteritems():
             if user:
                 monhost = '%s@%s' % (user, monhost)
@@ -201,44 +223,75 @@ class Ceph(Cluster):
                     cmd = "%s %s" % (common.setup_valgrind(self.mon_valgrind, 'mon.%s' % monhost, self.tmp_dir), cmd)
                 else:
                     cmd = 'ceph-run %s' % cmd
-                common.pdsh(monhost, 'sudo %s' % cmd).communicate()
+                procs.append(common.pdsh(monhost, 'sudo %s' % cmd))
+        for p in procs:
+            p.communicate()
 
     def make_osds(self):
-        osdnum = 0
         osdhosts = settings.cluster.get('osds')
+        user = settings.cluster.get('user')
+        osds = []
+        ctx = {'conf': self.tmp_conf, 'osd_cmd': self.ceph_osd_cmd}
 
         for host in osdhosts:
-            user = settings.cluster.get('user')
+            pdshhost = host
             if user:
                 pdshhost = '%s@%s' % (user, host)
 
-            for i in xrange(0, settings.cluster.get('osds_per_node')):            
-                # Build the OSD
-                osduuid = str(uuid.uuid4())
-                key_fn = '%s/osd-device-%s-data/keyring' % (self.mnt_dir, i)
-                common.pdsh(pdshhost, 'sudo ceph -c %s osd create %s' % (self.tmp_conf, osduuid)).communicate()
-                common.pdsh(pdshhost, 'sudo ceph -c %s osd crush add osd.%d 1.0 host=%s rack=localrack root=default' % (self.tmp_conf, osdnum, host)).communicate()
-                common.pdsh(pdshhost, 'sudo sh -c "ulimit -n 16384 && ulimit -c unlimited && exec %s -c %s -i %d --mkfs --mkkey --osd-uuid %s"' % (self.ceph_osd_cmd, self.tmp_conf, osdnum, osduuid)).communicate()
-                common.pdsh(pdshhost, 'sudo ceph -c %s -i %s auth add osd.%d osd "allow *" mon "allow profile osd"' % (self.tmp_conf, key_fn, osdnum)).communicate()
-
-                # Start the OSD
-                pidfile="%s/ceph-osd.%d.pid" % (self.pid_dir, osdnum)
-                cmd = '%s -c %s -i %d --pid-file=%s' % (self.ceph_osd_cmd, self.tmp_conf, osdnum, pidfile)
-                if self.osd_valgrind:
-                    cmd = "%s %s" % (common.setup_valgrind(self.osd_valgrind, 'osd.%d' % osdnum, self.tmp_dir), cmd)
-                else:
-                    cmd = 'ceph-run %s' % cmd
+            for i in xrange(0, settings.cluster.get('osds_per_node')):
+                osds.append((host, pdshhost, i, str(uuid.uuid4())))
+        if not osds:
+            return
 
-                common.pdsh(pdshhost, 'sudo sh -c "ulimit -n 16384 && ulimit -c unlimited && exec %s"' % cmd).communicate()
-                osdnum = osdnum+1
+        # Create all of the OSDs with one head node script and read back the
+        # ids the mons actually assigned.
+        create_cmds = []
+        for host, pdshhost, i, osduuid in osds:
+            ctx.update(host=host, i=i, uuid=osduuid)
+            create_cmds.append(self.osd_create_tmpl.format(**ctx))
+        stdout, stderr = common.run_local_or_pdsh(self.nodes_head, ' ; '.join(create_cmds)).communicate()
+        osdids = {}
+        for line in stdout.splitlines():
+            if 'OSD:' in line:
+                osdid, osduuid = line.split('OSD:', 1)[1].split(':')[:2]
+                osdids[osduuid] = osdid
+
+        # Build the per-host scripts
+        host_cmds = {}
+        for host, pdshhost, i, osduuid in osds:
+            osdid = osdids.get(osduuid, '')
+            if not osdid.isdigit():
+                raise Exception('Unable to create OSD %s on %s, bailing!' % (osduuid, host))
+            osdnum = int(osdid)
+
+            # Build the OSD
+            ctx.update(host=host, i=i, uuid=osduuid, osdnum=osdnum)
+            ctx['key_fn'] = '%s/osd-device-%s-data/keyring' % (self.mnt_dir, i)
+            ctx['pidfile'] = '%s/ceph-osd.%d.pid' % (self.pid_dir, osdnum)
+            cmds = host_cmds.setdefault(pdshhost, [])
+            cmds.extend(tmpl.format(**ctx) for tmpl in self.osd_build_tmpls)
+
+            # Start the OSD
+            cmd = self.osd_start_tmpl.format(**ctx)
+            if self.osd_valgrind:
+                cmd = "%s %s" % (common.setup_valgrind(self.osd_valgrind, 'osd.%d' % osdnum, self.tmp_dir), cmd)
+            else:
+                cmd = 'ceph-run %s' % cmd
+
+            cmds.append('sudo sh -c "ulimit -n 16384 && ulimit -c unlimited && exec %s"' % cmd)
+
+        # Then build and start the OSDs on every host at once
+        procs = [common.pdsh(pdshhost, ' ; '.join(cmds)) for pdshhost, cmds in host_cmds.items()]
+        for p in procs:
+            p.communicate()
 
 
     def start_rgw(self):
         rgwhosts = settings.cluster.get('rgws', [])
+        user = settings.cluster.get('user')
 
         for host in rgwhosts:
             pdshhost = host
-            user = settings.cluster.get('user')
             if user:
                 pdshhost = '%s@%s' % (user, host)
             cmd = '%s -c %s -n client.radosgw.gateway --log-file=%s/rgw.log' % (self.ceph_rgw_cmd, self.tmp_conf, self.log_dir)
@@ -256,42 +309,88 @@ class Ceph(Cluster):
             logline = "| tee -a %s" % logfile
         ret = 0
 
-        # Match any of these things to continue checking health
-        check_list = ["degraded", "peering", "recovery_wait", "stuck", "inactive", "unclean", "recovery", "stale"]
+        check_set = _HEALTH_CHECK_SET if check_list is None else frozenset(check_list)
+        # The default wait backs off exponentially (1s up to 30s) so long waits
+        # don't hammer the head node.  The recovery test passes a
+        # check_list/logfile and times recovery from the log, so that path
+        # never backs off and keeps polling every second.
+        default_wait = check_list is None and not logfile
+        sleep_s = 1
         while True:
-            stdout, stderr = common.pdsh(settings.getnodes('head'), 'ceph -c %s health %s' % (self.tmp_conf, logline)).communicate()
-            if check_list and not set(check_list).intersection(stdout.split()):
+            stdout, stderr = common.run_local_or_pdsh(self.nodes_head, 'ceph -c %s health %s' % (self.tmp_conf, logline)).communicate()
+            if check_set and not any(word in check_set for word in stdout.split()):
                 break
             if "HEALTH_OK" in stdout:
                 break
             else:
                 ret = ret + 1
             logger.info("%s", stdout)
-            time.sleep(1)
+
+            if not default_wait:
+                # A custom check_list can be satisfied without HEALTH_OK (the
+                # recovery test runs with noup set), so just poll every second.
+                time.sleep(1)
+                continue
+
+            # Rather than sleeping, block in 'ceph -w' on the head node for up
+            # to sleep_s so we wake up as soon as the mons report HEALTH_OK.
+            # ceph -w replays recent cluster log entries, so the HEALTH_OK may
+            # be an old one; it only ends the sleep and the next 'ceph health'
+            # poll decides whether we're done.
+            start = time.time()
+            stdout, stderr = common.run_local_or_pdsh(self.nodes_head, 'bash -c "grep -m1 HEALTH_OK <(timeout %d stdbuf -oL ceph -c %s -w 2>/dev/null </dev/null)"' % (sleep_s, self.tmp_conf)).communicate()
+            elapsed = time.time() - start
+            # A hit in the first second is most likely the replay rather than a
+            # new event, so don't let it turn the backoff into a busy poll.  The
+            # same goes for the watch timing out or ceph -w failing.
+            if "HEALTH_OK" not in stdout or elapsed < 1:
+                time.sleep(max(0, sleep_s - elapsed))
+            sleep_s = min(sleep_s * 2, 30)
         return ret
 
     def check_scrub(self):
         logger.info('Waiting until Scrubbing completes...')
+        sleep_s = 1
         while True:
-            stdout, stderr = common.pdsh(settings.getnodes('head'), 'ceph -c %s pg dump | cut -f 16 | grep "0.000000" | wc -l' % self.tmp_conf).communicate()
-            if " 0\n" in stdout:
-                break
+            stdout, stderr = common.run_local_or_pdsh(self.nodes_head, 'ceph -c %s pg dump pgs --format=json 2>/dev/null' % self.tmp_conf).communicate()
+            # Skip the "host: " prefix pdsh adds when the command ran remotely
+            starts = [i for i in (stdout.find('['), stdout.find('{')) if i >= 0]
+            out = stdout[min(starts):] if starts else stdout
+            try:
+                pgs = json.loads(out)
+            except ValueError:
+                logger.info('Unable to parse pg dump: %s', stdout)
             else:
-                logger.info(stdout)
-            time.sleep(1)
+                # Newer releases wrap the pg list in a dict
+                if isinstance(pgs, dict):
+                    pgs = pgs.get('pg_stats', [])
+                # A zero scrub stamp means the pg hasn't had its initial scrub yet
+                unscrubbed = len([pg for pg in pgs if str(pg.get('last_scrub_stamp', '')).startswith('0.000000')])
+                if unscrubbed == 0:
+                    break
+                logger.info('%d pgs have not been scrubbed yet', unscrubbed)
+            time.sleep(sleep_s)
+            sleep_s = min(sleep_s * 2, 30)
 
     def dump_config(self, run_dir):
-        common.pdsh(settings.getnodes('osds'), 'sudo ceph -c %s --admin-daemon /var/run/ceph/ceph-osd.0.asok config show > %s/ceph_settings.out' % (self.tmp_conf, run_dir)).communicate()
+        common.pdsh(self.nodes_osds, 'sudo ceph -c %s --admin-daemon /var/run/ceph/ceph-osd.0.asok config show > %s/ceph_settings.out' % (self.tmp_conf, run_dir)).communicate()
 
     def dump_historic_ops(self, run_dir):
-        common.pdsh(settings.getnodes('osds'), 'find /var/run/ceph/*.asok -maxdepth 1 -exec sudo ceph --admin-daemon {} dump_historic_ops \; > %s/historic_ops.out' % run_dir).communicate()
+        common.pdsh(self.nodes_osds, 'find /var/run/ceph/*.asok -maxdepth 1 -exec sudo ceph --admin-daemon {} dump_historic_ops \; > %s/historic_ops.out' % run_dir).communicate()
 
     def set_osd_param(self, param, value):
-        common.pdsh(settings.getnodes('osds'), 'find /dev/disk/by-partlabel/osd-device-*data -exec readlink {} \; | cut -d"/" -f 3 | sed "s/[0-9]$//" | xargs -I{} sudo sh -c "echo %s > /sys/block/\'{}\'/queue/%s"' % (value, param))
+        self.set_osd_params({param: value})
+
+    def set_osd_params(self, params):
+        if not params:
+            return
+        # Find the devices once and write every queue param on each of them
+        echos = '; '.join('echo %s > /sys/block/\'{}\'/queue/%s' % (value, param) for param, value in params.items())
+        common.pdsh(self.nodes_osds, 'find /dev/disk/by-partlabel/osd-device-*data -exec readlink {} \; | cut -d"/" -f 3 | sed "s/[0-9]$//" | xargs -I{} sudo sh -c "%s"' % echos).communicate()
 
 
     def __str__(self):
-        return "foo"
+        return "Ceph(conf=%s)" % self.tmp_conf
 
     def create_recovery_test(self, run_dir, callback):
         rt_config = self.config.get("recovery_test", {})
@@ -301,10 +400,7 @@ class Ceph(Cluster):
 
     def wait_recovery_done(self):
         self.stoprequest.set()
-        while True:
-            threads = threading.enumerate()
-            if len(threads) == 1: break
-            self.rt.join(1)
+        self.rt.join()
 
     # FIXME: This is a total hack that assumes there is only 1 existing ruleset!
     # Will change pending a fix for http://tracker.ceph.com/issues/8060
@@ -317,32 +413,34 @@ class Ceph(Cluster):
 
     def get_ruleset(self, name):
         name = str(name)
-        logger.info("%s", self.ruleset_map)
+        logger.debug("ruleset_map=%s", self.ruleset_map)
         return self.ruleset_map[name]
 
     def make_profiles(self):
         crush_profiles = self.config.get('crush_profiles', {})
         for name,profile in crush_profiles.items():
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd crush add-bucket %s-root root' % (self.tmp_conf, name)).communicate()
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd crush add-bucket %s-rack rack' % (self.tmp_conf, name)).communicate()
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd crush move %s-rack root=%s-root' % (self.tmp_conf, name, name)).communicate()
-            # FIXME: We need to build a dict mapping OSDs to hosts and create a proper hierarchy!
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd crush add-bucket %s-host host' % (self.tmp_conf, name)).communicate()
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd crush move %s-host rack=%s-rack' % (self.tmp_conf, name, name)).communicate()
-            
             osds = profile.get('osds', None)
             if not osds:
                 raise Exception("No OSDs defined for crush profile, bailing!")
-            for i in osds:
-                common.pdsh(settings.getnodes('head'), 'ceph -c %s osd crush set %s 1.0 host=%s-host' % (self.tmp_conf, i, name)).communicate()
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd crush rule create-simple %s %s-root osd' % (self.tmp_conf, name, name)).communicate()
+
+            # Each step depends on the previous one, so chain them with && in one pdsh run
+            cmds = ['osd crush add-bucket %s-root root' % name,
+                    'osd crush add-bucket %s-rack rack' % name,
+                    'osd crush move %s-rack root=%s-root' % (name, name),
+                    # FIXME: We need to build a dict mapping OSDs to hosts and create a proper hierarchy!
+                    'osd crush add-bucket %s-host host' % name,
+                    'osd crush move %s-host rack=%s-rack' % (name, name)]
+            cmds.extend('osd crush set %s 1.0 host=%s-host' % (i, name) for i in osds)
+            cmds.append('osd crush rule create-simple %s %s-root osd' % (name, name))
+            script = ' && '.join('ceph -c %s %s' % (self.tmp_conf, cmd) for cmd in cmds)
+            common.run_local_or_pdsh(self.nodes_head, script).communicate()
             self.set_ruleset(name)
 
         erasure_profiles = self.config.get('erasure_profiles', {})
         for name,profile in erasure_profiles.items():
             k = profile.get('erasure_k', 6)
             m = profile.get('erasure_m', 2)
-	    common.pdsh(settings.getnodes('head'), 'ceph -c %s osd erasure-code-profile set %s ruleset-failure-domain=osd k=%s m=%s' % (self.tmp_conf, name, k, m)).communicate()
+	    common.run_local_or_pdsh(self.nodes_head, 'ceph -c %s osd erasure-code-profile set %s ruleset-failure-domain=osd k=%s m=%s' % (self.tmp_conf, name, k, m)).communicate()
             self.set_ruleset(name)
 
     def mkpool(self, name, profile_name, base_name=None):
@@ -363,43 +461,38 @@ class Ceph(Cluster):
         target_max_bytes = profile.get('target_max_bytes', None)
         min_read_recency_for_promote = profile.get('min_read_recency_for_promote', None)
 
-#        common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool delete %s %s --yes-i-really-really-mean-it' % (self.tmp_conf, name, name)).communicate()
-        common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool create %s %d %d %s' % (self.tmp_conf, name, pg_size, pgp_size, erasure_profile)).communicate()
-
-        if replication and replication == 'erasure':
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool create %s %d %d erasure %s' % (self.tmp_conf, name, pg_size, pgp_size, erasure_profile)).communicate()
+#        common.run_local_or_pdsh(self.nodes_head, 'sudo ceph -c %s osd pool delete %s %s --yes-i-really-really-mean-it' % (self.tmp_conf, name, name)).communicate()
+        if replication == 'erasure':
+            cmd = 'osd pool create %s %d %d erasure %s' % (name, pg_size, pgp_size, erasure_profile)
         else:
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool create %s %d %d' % (self.tmp_conf, name, pg_size, pgp_size)).communicate()
-
-        logger.info('Checking Healh after pool creation.')
-        self.check_health()
+            cmd = 'osd pool create %s %d %d' % (name, pg_size, pgp_size)
+        common.run_local_or_pdsh(self.nodes_head, 'sudo ceph -c %s %s' % (self.tmp_conf, cmd)).communicate()
 
+        # Apply all of the pool settings with a single pdsh run, before the
+        # pool becomes a cache tier (size was always set first)
+        pool_settings = []
         if replication and replication.isdigit():
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool set %s size %s' % (self.tmp_conf, name, replication)).communicate()
-            logger.info('Checking Health after setting pool replication level.')
-            self.check_health()
+            pool_settings.append(('size', replication))
+        if crush_profile:
+            pool_settings.append(('crush_ruleset', self.get_ruleset(crush_profile)))
+        for param, value in [('hit_set_type', hit_set_type),
+                             ('hit_set_count', hit_set_count),
+                             ('hit_set_period', hit_set_period),
+                             ('target_max_objects', target_max_objects),
+                             ('target_max_bytes', target_max_bytes),
+                             ('min_read_recency_for_promote', min_read_recency_for_promote)]:
+            if value:
+                pool_settings.append((param, value))
+        if pool_settings:
+            cmds = ['sudo ceph -c %s osd pool set %s %s %s' % (self.tmp_conf, name, param, value) for param, value in pool_settings]
+            common.run_local_or_pdsh(self.nodes_head, ' ; '.join(cmds)).communicate()
 
         if base_name and cache_mode:
             logger.info("Adding %s as cache tier for %s.", name, base_name)
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd tier add %s %s' % (self.tmp_conf, base_name, name)).communicate()
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd tier cache-mode %s %s' % (self.tmp_conf, name, cache_mode)).communicate()
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd tier set-overlay %s %s' % (self.tmp_conf, base_name, name)).communicate()
+            common.run_local_or_pdsh(self.nodes_head, 'sudo ceph -c %s osd tier add %s %s' % (self.tmp_conf, base_name, name)).communicate()
+            common.run_local_or_pdsh(self.nodes_head, 'sudo ceph -c %s osd tier cache-mode %s %s' % (self.tmp_conf, name, cache_mode)).communicate()
+            common.run_local_or_pdsh(self.nodes_head, 'sudo ceph -c %s osd tier set-overlay %s %s' % (self.tmp_conf, base_name, name)).communicate()
 
-        if crush_profile:
-            ruleset = self.get_ruleset(crush_profile)
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool set %s crush_ruleset %s' % (self.tmp_conf, name, ruleset)).communicate()
-        if hit_set_type:
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool set %s hit_set_type %s' % (self.tmp_conf, name, hit_set_type)).communicate()
-        if hit_set_count:
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool set %s hit_set_count %s' % (self.tmp_conf, name, hit_set_count)).communicate()
-        if hit_set_period:
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool set %s hit_set_period %s' % (self.tmp_conf, name, hit_set_period)).communicate()
-        if target_max_objects:
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool set %s target_max_objects %s' % (self.tmp_conf, name, target_max_objects)).communicate()
-        if target_max_bytes:
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool set %s target_max_bytes %s' % (self.tmp_conf, name, target_max_bytes)).communicate()
-        if min_read_recency_for_promote:
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool set %s min_read_recency_for_promote %s' % (self.tmp_conf, name, min_read_recency_for_promote)).communicate()
         logger.info('Final Pool Health Check.')
         self.check_health()
 
@@ -416,14 +509,14 @@ class Ceph(Cluster):
             cache_name = '%s-cache' % name
 
             # flush and remove the overlay and such
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd tier cache-mode %s forward' % (self.tmp_conf, cache_name)).communicate()
-            common.pdsh(settings.getnodes('head'), 'sudo rados -c %s -p %s cache-flush-evict-all' % (self.tmp_conf, cache_name)).communicate()
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd tier remove-overlay %s' % (self.tmp_conf, name)).communicate()
-            common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd tier remove %s %s' % (self.tmp_conf, name, cache_name)).communicate()
+            common.run_local_or_pdsh(self.nodes_head, 'sudo ceph -c %s osd tier cache-mode %s forward' % (self.tmp_conf, cache_name)).communicate()
+            common.run_local_or_pdsh(self.nodes_head, 'sudo rados -c %s -p %s cache-flush-evict-all' % (self.tmp_conf, cache_name)).communicate()
+            common.run_local_or_pdsh(self.nodes_head, 'sudo ceph -c %s osd tier remove-overlay %s' % (self.tmp_conf, name)).communicate()
+            common.run_local_or_pdsh(self.nodes_head, 'sudo ceph -c %s osd tier remove %s %s' % (self.tmp_conf, name, cache_name)).communicate()
 
             # delete the cache pool
             self.rmpool(cache_name, cache_profile)
-        common.pdsh(settings.getnodes('head'), 'sudo ceph -c %s osd pool delete %s %s --yes-i-really-really-mean-it' % (self.tmp_conf, name, name)).communicate()
+        common.run_local_or_pdsh(self.nodes_head, 'sudo ceph -c %s osd pool delete %s %s --yes-i-really-really-mean-it' % (self.tmp_conf, name, name)).communicate()
 
     def rbd_unmount(self):
         common.pdsh(settings.getnodes('clients'), 'sudo find /dev/rbd* -maxdepth 0 -type b -exec umount \'{}\' \;').communicate()
@@ -449,61 +542,84 @@ class RecoveryTestThread(threading.Thread):
 
     def pre(self):
         pre_time = self.config.get("pre_time", 60)
-        common.pdsh(settings.getnodes('head'), self.logcmd('Starting Recovery Test Thread, waiting %s seconds.' % pre_time)).communicate()
-        time.sleep(pre_time)
+        common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Starting Recovery Test Thread, waiting %s seconds.' % pre_time)).communicate()
+        if self.stoprequest.wait(pre_time):
+            # Parent finished before the test started, let post() wrap up
+            self.state = 'post'
+            return
         lcmd = self.logcmd("Setting the ceph osd noup flag")
-        common.pdsh(settings.getnodes('head'), 'ceph -c %s ceph osd set noup;%s' % (self.cluster.tmp_conf, lcmd)).communicate()
+        common.run_local_or_pdsh(self.cluster.nodes_head, 'ceph -c %s ceph osd set noup;%s' % (self.cluster.tmp_conf, lcmd)).communicate()
         self.state = 'markdown'
 
     def markdown(self):
+        if self.stoprequest.is_set():
+            # pre() has already set noup, so undo that on the way out
+            self.markup()
+            self.state = 'post'
+            return
+
         for osdnum in self.config.get('osds'):
             lcmd = self.logcmd("Marking OSD %s down." % osdnum)
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd down %s;%s' % (self.cluster.tmp_conf, osdnum, lcmd)).communicate()
+            common.run_local_or_pdsh(self.cluster.nodes_head, 'ceph -c %s osd down %s;%s' % (self.cluster.tmp_conf, osdnum, lcmd)).communicate()
             lcmd = self.logcmd("Marking OSD %s out." % osdnum)
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd out %s;%s' % (self.cluster.tmp_conf, osdnum, lcmd)).communicate()
-        common.pdsh(settings.getnodes('head'), self.logcmd('Waiting for the cluster to break and heal')).communicate()
+            common.run_local_or_pdsh(self.cluster.nodes_head, 'ceph -c %s osd out %s;%s' % (self.cluster.tmp_conf, osdnum, lcmd)).communicate()
+        common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Waiting for the cluster to break and heal')).communicate()
 
         self.state = 'osdout'
 
     def osdout(self):
+        if self.stoprequest.is_set():
+            common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('stoprequest is set, bringing the OSDs back without waiting.')).communicate()
+            self.markup()
+            self.state = 'post'
+            return
+
         ret = self.cluster.check_health(self.health_checklist, "%s/recovery.log" % self.config.get('run_dir'))
-        common.pdsh(settings.getnodes('head'), self.logcmd("ret: %s" % ret)).communicate()
+        common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd("ret: %s" % ret)).communicate()
 
         if self.outhealthtries < self.maxhealthtries and ret == 0:
             self.outhealthtries = self.outhealthtries + 1
+            self.stoprequest.wait(5)
             return # Cluster hasn't become unhealthy yet.
 
         if ret == 0:
-            common.pdsh(settings.getnodes('head'), self.logcmd('Cluster never went unhealthy.')).communicate()
+            common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Cluster never went unhealthy.')).communicate()
         else:
-            common.pdsh(settings.getnodes('head'), self.logcmd('Cluster appears to have healed.')).communicate()
+            common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Cluster appears to have healed.')).communicate()
+
+        self.markup()
+        self.state = "osdin"
 
+    def markup(self):
         lcmd = self.logcmd("Unsetting the ceph osd noup flag")
-        common.pdsh(settings.getnodes('head'), 'ceph -c %s ceph osd unset noup;%s' % (self.cluster.tmp_conf, lcmd)).communicate()
+        common.run_local_or_pdsh(self.cluster.nodes_head, 'ceph -c %s ceph osd unset noup;%s' % (self.cluster.tmp_conf, lcmd)).communicate()
         for osdnum in self.config.get('osds'):
             lcmd = self.logcmd("Marking OSD %s up." % osdnum)
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd up %s;%s' % (self.cluster.tmp_conf, osdnum, lcmd)).communicate()
+            common.run_local_or_pdsh(self.cluster.nodes_head, 'ceph -c %s osd up %s;%s' % (self.cluster.tmp_conf, osdnum, lcmd)).communicate()
             lcmd = self.logcmd("Marking OSD %s in." % osdnum)
-            common.pdsh(settings.getnodes('head'), 'ceph -c %s osd in %s;%s' % (self.cluster.tmp_conf, osdnum, lcmd)).communicate()
-
-        self.state = "osdin"
+            common.run_local_or_pdsh(self.cluster.nodes_head, 'ceph -c %s osd in %s;%s' % (self.cluster.tmp_conf, osdnum, lcmd)).communicate()
 
     def osdin(self):
+        if self.stoprequest.is_set():
+            self.state = 'post'
+            return
+
         # Wait until the cluster is healthy.
         ret = self.cluster.check_health(self.health_checklist, "%s/recovery.log" % self.config.get('run_dir'))
         if self.inhealthtries < self.maxhealthtries and ret == 0:
             self.inhealthtries = self.inhealthtries + 1
+            self.stoprequest.wait(5)
             return # Cluster hasn't become unhealthy yet.
 
         if ret == 0:
-            common.pdsh(settings.getnodes('head'), self.logcmd('Cluster never went unhealthy.')).communicate()
+            common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Cluster never went unhealthy.')).communicate()
         else:
-            common.pdsh(settings.getnodes('head'), self.logcmd('Cluster appears to have healed.')).communicate()
+            common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Cluster appears to have healed.')).communicate()
         self.state = "post"
 
     def post(self):
-        if self.stoprequest.isSet():
-            common.pdsh(settings.getnodes('head'), self.logcmd('Cluster is healthy, but stoprequest is set, finishing now.')).communicate()
+        if self.stoprequest.is_set():
+            common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Cluster is healthy, but stoprequest is set, finishing now.')).communicate()
             self.haltrequest.set()
             return
 
@@ -512,28 +628,29 @@ class RecoveryTestThread(threading.Thread):
             self.outhealthtries = 0
             self.inhealthtries = 0
 
-            common.pdsh(settings.getnodes('head'), self.logcmd('Cluster is healthy, but repeat is set.  Moving to "markdown" state.')).communicate()
+            common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Cluster is healthy, but repeat is set.  Moving to "markdown" state.')).communicate()
             self.state = "markdown"
             return
 
         post_time = self.config.get("post_time", 60)
-        common.pdsh(settings.getnodes('head'), self.logcmd('Cluster is healthy, completion in %s seconds.' % post_time)).communicate()
-        time.sleep(post_time)
+        common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Cluster is healthy, completion in %s seconds.' % post_time)).communicate()
+        if self.stoprequest.wait(post_time):
+            return # post() will see the stoprequest and finish
         self.state = "done"
 
     def done(self):
-        common.pdsh(settings.getnodes('head'), self.logcmd("Done.  Calling parent callback function.")).communicate()
+        common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd("Done.  Calling parent callback function.")).communicate()
         self.callback()
         self.haltrequest.set()
 
     def join(self, timeout=None):
-        common.pdsh(settings.getnodes('head'), self.logcmd('Received notification that parent is finished and waiting.')).communicate()
+        common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Received notification that parent is finished and waiting.')).communicate()
         super(RecoveryTestThread, self).join(timeout)
 
     def run(self):
         self.haltrequest.clear()
         self.stoprequest.clear()
-        while not self.haltrequest.isSet():
+        while not self.haltrequest.is_set():
           self.states[self.state]()
-        common.pdsh(settings.getnodes('head'), self.logcmd('Exiting recovery test thread.  Last state was: %s' % self.state)).communicate()
+        common.run_local_or_pdsh(self.cluster.nodes_head, self.logcmd('Exiting recovery test thread.  Last state was: %s' % self.state)).communicate()
 
@@ -4,6 +4,8 @@ import time
 import os
 import errno
 import logging
+import socket
+import getpass
 
 logger = logging.getLogger("cbt")
 
@@ -12,6 +14,37 @@ def pdsh(nodes, command):
     logger.debug('pdsh: %s' % args)
     return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
 
+# Names of the machine running cbt, filled in on first use by is_localhost().
+# The fqdn needs a reverse DNS lookup, so it is only resolved when a host's
+# short name already matches ours.
+local_names = {}
+
+def is_localhost(nodes):
+    if ',' in nodes:
+        return False
+    user, sep, host = nodes.rpartition('@')
+    if user and user != getpass.getuser():
+        return False
+
+    if 'hostname' not in local_names:
+        local_names['hostname'] = socket.gethostname()
+    hostname = local_names['hostname']
+    if host in ('localhost', hostname):
+        return True
+    if host.split('.')[0] != hostname.split('.')[0]:
+        return False
+
+    if 'fqdn' not in local_names:
+        local_names['fqdn'] = socket.getfqdn()
+    return host == local_names['fqdn']
+
+def run_local_or_pdsh(nodes, command):
+    # Skip the ssh round trip when the only target is the machine running cbt
+    if not is_localhost(nodes):
+        return pdsh(nodes, command)
+    logger.debug('local: %s', command)
+    return subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+
 def pdcp(nodes, flags, localfile, remotefile):
     args = ['pdcp', '-f', '1', '-R', 'ssh', '-w', nodes, localfile, remotefile]
     if flags: